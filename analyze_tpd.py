@@ -3,85 +3,172 @@ Tests Pending at Discharge - Analysis and Visualization
 Analytics on FHIR 2025 Conference Demo
 """
 
+import functools
+import hashlib
+import io
 import json
 import glob
+import os
+import tempfile
+import numpy as np
+import orjson
 import pandas as pd
 import plotly.express as px
-from pysof import run_view_definition
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from pysof import __version__ as pysof_version, run_view_definition
 from datetime import datetime
 
+# ViewDefinition results are cached here as Parquet between runs
+CACHE_DIR = '.cache'
+
+# Labels for the days-post-discharge buckets, and the (inclusive) upper edge
+# in days of every bucket but the last
+BUCKET_LABELS = ['0-1', '1-2', '2-3', '3-4', '4-6', '6-10', '10+']
+BUCKET_EDGES = np.array([1, 2, 3, 4, 6, 10])
+
+# pysof takes its input as a Bundle of resource dicts, so NDJSON is parsed into
+# Python objects here; a columnar reader such as pyarrow.json would only have
+# to be converted back into dicts before pysof could use it
 def load_ndjson_resources(file_path):
-    """Load FHIR resources from an NDJSON file"""
-    resources = []
-    with open(file_path, 'r') as f:
+    """Iterate over the FHIR resources in an NDJSON file"""
+    with open(file_path, 'rb') as f:
         for line in f:
-            line = line.strip()
-            if line:
-                resources.append(json.loads(line))
-    return resources
+            # orjson parses bytes directly and tolerates the trailing newline
+            if not line.isspace():
+                yield orjson.loads(line)
 
 def load_view_definition(file_path):
     """Load a ViewDefinition from JSON file"""
     with open(file_path, 'r') as f:
         return json.load(f)
 
-def main():
-    print("=" * 60)
-    print("Tests Pending at Discharge - Analysis")
-    print("=" * 60)
+def make_bundle(resources):
+    """Wrap FHIR resources in a collection Bundle for pysof"""
+    return {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [{"resource": r} for r in resources]
+    }
 
-    # Define data paths
-    fhir_dir = 'synthea/output/fhir'
+def result_to_dataframe(result):
+    """Load a pysof Parquet result into a DataFrame"""
+    return pd.read_parquet(io.BytesIO(result)) if result else pd.DataFrame()
+
+def run_view_on_ndjson(view, ndjson_path):
+    """Run a ViewDefinition over the FHIR resources in an NDJSON file"""
+    # Resources are streamed straight into the Bundle entries rather than
+    # collected in a list first, and the Bundle is released once the view has run
+    bundle = make_bundle(load_ndjson_resources(ndjson_path))
+    print(f"   Loaded {len(bundle['entry'])} {view['resource']} resources")
+    return run_view_definition(
+        view=view,
+        bundle=bundle,
+        format="parquet"
+    )
 
-    # Load FHIR data from NDJSON files
-    print("\n1. Loading FHIR data from NDJSON files...")
-    encounters = load_ndjson_resources(f'{fhir_dir}/Encounter.ndjson')
-    observations = load_ndjson_resources(f'{fhir_dir}/Observation.ndjson')
-    print(f"   Loaded {len(encounters)} encounters")
-    print(f"   Loaded {len(observations)} observations")
+def run_view_cached(view, ndjson_path):
+    """Run a ViewDefinition over an NDJSON file, reusing the cached result
+    from a previous run if neither the file nor the view has changed"""
+    fingerprint = (
+        f"{pysof_version}:{ndjson_path}:{os.path.getmtime(ndjson_path)}:{os.path.getsize(ndjson_path)}:"
+        f"{json.dumps(view, sort_keys=True)}"
+    )
+    key = hashlib.blake2b(fingerprint.encode(), digest_size=16).hexdigest()
+    # Entries for the same view and NDJSON file share a prefix, so a new
+    # result can replace the ones it supersedes
+    path_hash = hashlib.blake2b(ndjson_path.encode(), digest_size=4).hexdigest()
+    prefix = os.path.join(CACHE_DIR, f"{view['name']}-{path_hash}")
+    cache_path = f'{prefix}-{key}.parquet'
+    if os.path.exists(cache_path):
+        print(f"   Using cached {view['name']} result")
+        return pd.read_parquet(cache_path)
+
+    result = run_view_on_ndjson(view, ndjson_path)
+    if result:
+        # pysof already returns Parquet, so the result is cached as-is; write
+        # to a uniquely named temporary file first so an interrupted run or a
+        # concurrent one never leaves a truncated or interleaved cache entry
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False) as f:
+            try:
+                f.write(result)
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        for stale_path in glob.glob(f'{glob.escape(prefix)}-*.parquet'):
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+        os.replace(f.name, cache_path)
+    return result_to_dataframe(result)
+
+def write_csv(df, file_path):
+    """Export a DataFrame to CSV using Arrow's columnar CSV writer"""
+    pacsv.write_csv(
+        pa.Table.from_pandas(df, preserve_index=False),
+        file_path,
+        # Keep the header row unquoted, as pandas wrote it
+        write_options=pacsv.WriteOptions(batch_size=65536, quoting_header='none')
+    )
 
+@functools.lru_cache(maxsize=2)
+def run_view_memoised(view_json, ndjson_path, file_key):
+    """Run a ViewDefinition (given as JSON text) over an NDJSON file.
+
+    Results are memoised for the life of the process; file_key carries the
+    NDJSON file's mtime and size so that a changed file produces a new entry.
+    """
+    return run_view_cached(json.loads(view_json), ndjson_path)
+
+def run_view(view, ndjson_path):
+    """Run a ViewDefinition over an NDJSON file, at most once per process for
+    unchanged inputs"""
+    file_key = (os.path.getmtime(ndjson_path), os.path.getsize(ndjson_path))
+    df = run_view_memoised(json.dumps(view, sort_keys=True), ndjson_path, file_key)
+    # Callers add and rewrite columns; with Copy-on-Write a shallow copy is
+    # enough to keep those changes out of the memoised frame
+    return df.copy(deep=False)
+
+def load_views(fhir_dir, enc_view_path, obs_view_path):
+    """Load both ViewDefinitions and return the (encounter, observation)
+    DataFrames produced by running them over the NDJSON files in fhir_dir"""
     # Load ViewDefinitions
-    print("\n2. Loading ViewDefinitions...")
-    enc_view = load_view_definition('EncounterView.json')
-    obs_view = load_view_definition('LabObservationView.json')
+    print("\n1. Loading ViewDefinitions...")
+    enc_view = load_view_definition(enc_view_path)
+    obs_view = load_view_definition(obs_view_path)
     print("   ✓ EncounterView")
     print("   ✓ LabObservationView")
 
-    # Execute ViewDefinitions
-    print("\n3. Running SQL on FHIR transformations...")
-
-    # Create bundles from resources for pysof
-    encounter_bundle = {
-        "resourceType": "Bundle",
-        "type": "collection",
-        "entry": [{"resource": e} for e in encounters]
-    }
-    observation_bundle = {
-        "resourceType": "Bundle",
-        "type": "collection",
-        "entry": [{"resource": o} for o in observations]
-    }
+    # Execute ViewDefinitions over the NDJSON files
+    print("\n2. Running SQL on FHIR transformations...")
 
     # Run Encounter view
-    enc_result = run_view_definition(
-        view=enc_view,
-        bundle=encounter_bundle,
-        format="json"
-    )
-    enc_df = pd.DataFrame(json.loads(enc_result)) if enc_result else pd.DataFrame()
+    enc_df = run_view(enc_view, f'{fhir_dir}/Encounter.ndjson')
     print(f"   ✓ Processed {len(enc_df)} encounters")
 
     # Run Observation view
-    obs_result = run_view_definition(
-        view=obs_view,
-        bundle=observation_bundle,
-        format="json"
-    )
-    obs_df = pd.DataFrame(json.loads(obs_result)) if obs_result else pd.DataFrame()
+    obs_df = run_view(obs_view, f'{fhir_dir}/Observation.ndjson')
     print(f"   ✓ Processed {len(obs_df)} lab observations")
 
+    return enc_df, obs_df
+
+def main():
+    print("=" * 60)
+    print("Tests Pending at Discharge - Analysis")
+    print("=" * 60)
+
+    # Define data paths
+    fhir_dir = 'synthea/output/fhir'
+
+    # Load the ViewDefinitions and run them over the FHIR data
+    enc_df, obs_df = load_views(fhir_dir, 'EncounterView.json', 'LabObservationView.json')
+
     # Calculate summary statistics
-    print("\n4. Summary Statistics")
+    print("\n3. Summary Statistics")
     print("   " + "-" * 50)
 
     # Define culture lab LOINC codes
@@ -99,39 +186,64 @@ def main():
 
         # Merge observations with TPD encounters
         # Use start_time as "discharge" reference (in this model, delays are measured from encounter start)
-        obs_with_enc = obs_df.merge(
-            tpd_encounters[['encounter_id', 'start_time', 'end_time']],
+        # Joining against an encounter_id index avoids re-hashing the encounter
+        # keys; validate guards against duplicate encounters fanning out rows
+        tpd_enc_idx = tpd_encounters.set_index('encounter_id')[['start_time', 'end_time']]
+        # Only the observation columns the analysis uses are carried through
+        # the join; the full frame is still what gets exported
+        obs_with_enc = obs_df[['encounter_id', 'issued_time', 'lab_code']].join(
+            tpd_enc_idx,
             on='encounter_id',
-            how='inner'
+            how='inner',
+            validate='m:1'
         )
 
-        # Convert timestamps for comparison
-        obs_with_enc['issued_dt'] = pd.to_datetime(obs_with_enc['issued_time'], errors='coerce', utc=True)
-        obs_with_enc['start_dt'] = pd.to_datetime(obs_with_enc['start_time'], errors='coerce', utc=True)
+        # Parse timestamps once into plain UTC datetime64 arrays for comparison,
+        # keeping the unit pandas parsed so far-off dates don't overflow
+        issued = pd.to_datetime(
+            obs_with_enc['issued_time'], errors='coerce', utc=True, format='ISO8601'
+        ).dt.tz_convert(None).to_numpy()
+        start = pd.to_datetime(
+            obs_with_enc['start_time'], errors='coerce', utc=True, format='ISO8601'
+        ).dt.tz_convert(None).to_numpy()
 
         # Calculate days from encounter start (represents delay until lab result available)
-        obs_with_enc['days_post_discharge'] = (
-            (obs_with_enc['issued_dt'] - obs_with_enc['start_dt']).dt.total_seconds() / 86400
-        )
+        days = (issued - start) / np.timedelta64(1, 'D')
+
+        # Assign day buckets like the reference image, stored as int8 indexes
+        # into BUCKET_LABELS; a bucket covers (previous edge, edge], and labs
+        # with unknown timing get -1
+        bucket_idx = np.searchsorted(BUCKET_EDGES, days, side='left').astype(np.int8)
+        bucket_idx[np.isnan(days)] = -1
+        obs_with_enc['bucket_idx'] = bucket_idx
 
         # Classify as Culture vs Other
-        obs_with_enc['is_culture'] = obs_with_enc['lab_code'].isin(CULTURE_CODES)
+        obs_with_enc['is_culture'] = pc.is_in(
+            pa.array(obs_with_enc['lab_code']),
+            value_set=pa.array(sorted(CULTURE_CODES))
+        ).to_numpy(zero_copy_only=False)
 
-        # All labs from TPD encounters are "pending" (they have delays)
-        obs_with_enc['is_pending'] = obs_with_enc['days_post_discharge'] > 0
+        # All labs from TPD encounters are "pending" (they have delays); this
+        # NumPy mask is reused directly by the counts and filters below
+        is_pending = days > 0
 
-        # Count pending labs per encounter
-        pending_per_encounter = obs_with_enc[obs_with_enc['is_pending']].groupby('encounter_id').size().reset_index(name='pending_lab_count')
+        # Count pending labs per encounter: factorize only the pending rows'
+        # encounter ids and bincount the resulting codes
+        pending_codes, pending_ids = pd.factorize(obs_with_enc['encounter_id'][is_pending])
+        counts = np.bincount(pending_codes[pending_codes >= 0], minlength=len(pending_ids))
+        pending_per_encounter = pd.Series(counts, index=pending_ids)
 
-        # Merge with encounters
-        enc_df = enc_df.merge(pending_per_encounter, on='encounter_id', how='left')
-        enc_df['pending_lab_count'] = enc_df['pending_lab_count'].fillna(0).astype(int)
+        # Attach counts to encounters; the lookup table is at most one row per
+        # TPD encounter, so a map is much cheaper than merging the full frame
+        enc_df['pending_lab_count'] = enc_df['encounter_id'].map(pending_per_encounter).fillna(0).astype('int32')
 
         encounters_with_pending = len(enc_df[enc_df['pending_lab_count'] > 0])
-        total_pending_labs = obs_with_enc['is_pending'].sum()
+        total_pending_labs = int(is_pending.sum())
         total_cultures = obs_with_enc['is_culture'].sum()
         total_other = len(obs_with_enc) - total_cultures
+        has_obs_with_enc = len(obs_with_enc) > 0
     else:
+        has_obs_with_enc = False
         encounters_with_pending = 0
         total_pending_labs = 0
         total_cultures = 0
@@ -143,7 +255,7 @@ def main():
 
     print(f"   Total encounters: {len(enc_df)}")
     print(f"   Total lab observations: {len(obs_df)}")
-    print(f"   Labs from TPD encounters: {len(obs_with_enc) if 'obs_with_enc' in dir() else 0}")
+    print(f"   Labs from TPD encounters: {len(obs_with_enc) if has_obs_with_enc else 0}")
     print(f"   - Cultures: {total_cultures}")
     print(f"   - Other: {total_other}")
     print(f"   Encounters with pending labs: {encounters_with_pending}")
@@ -158,40 +270,28 @@ def main():
             print(f"   Maximum pending labs (single encounter): {max_pending}")
 
     # Create visualization
-    print("\n5. Generating visualization...")
+    print("\n4. Generating visualization...")
 
-    if len(obs_df) > 0 and 'obs_with_enc' in dir() and len(obs_with_enc) > 0:
+    if has_obs_with_enc:
         # Filter to pending labs only
-        pending_labs = obs_with_enc[obs_with_enc['is_pending']].copy()
+        # take() already returns a new frame, so no extra copy is needed
+        pending_labs = obs_with_enc.take(np.flatnonzero(is_pending))
 
         if len(pending_labs) > 0:
-            # Assign to day buckets like the reference image
-            def assign_bucket(days):
-                if days <= 1:
-                    return '0-1'
-                elif days <= 2:
-                    return '1-2'
-                elif days <= 3:
-                    return '2-3'
-                elif days <= 4:
-                    return '3-4'
-                elif days <= 6:
-                    return '4-6'
-                elif days <= 10:
-                    return '6-10'
-                else:
-                    return '10+'
-
-            pending_labs['bucket'] = pending_labs['days_post_discharge'].apply(assign_bucket)
-            pending_labs['lab_type'] = pending_labs['is_culture'].map({True: 'Cultures', False: 'Other'})
-
-            # Aggregate by bucket and lab type
-            bucket_data = pending_labs.groupby(['bucket', 'lab_type']).size().reset_index(name='count')
-
-            # Ensure proper bucket ordering
-            bucket_order = ['0-1', '1-2', '2-3', '3-4', '4-6', '6-10', '10+']
-            bucket_data['bucket'] = pd.Categorical(bucket_data['bucket'], categories=bucket_order, ordered=True)
-            bucket_data = bucket_data.sort_values('bucket')
+            # Aggregate by bucket and lab type in one bincount; row i of the
+            # result holds the (other, culture) counts for BUCKET_LABELS[i]
+            bucket_counts = np.bincount(
+                pending_labs['bucket_idx'].to_numpy() * 2 + pending_labs['is_culture'].to_numpy(),
+                minlength=len(BUCKET_LABELS) * 2
+            ).reshape(-1, 2)
+
+            # Only the handful of aggregated rows are turned into labelled data
+            bucket_data = pd.DataFrame({
+                'bucket': np.repeat(BUCKET_LABELS, 2),
+                'lab_type': ['Cultures', 'Other'] * len(BUCKET_LABELS),
+                'count': bucket_counts[:, ::-1].ravel()
+            })
+            bucket_data = bucket_data[bucket_data['count'] > 0]
 
             # Create stacked bar chart like reference image
             fig = px.bar(
@@ -209,7 +309,7 @@ def main():
                     'Cultures': '#1f4e79',  # Dark blue
                     'Other': '#5b9bd5'      # Light blue
                 },
-                category_orders={'bucket': bucket_order}
+                category_orders={'bucket': BUCKET_LABELS}
             )
             fig.update_layout(
                 height=500,
@@ -230,10 +330,8 @@ def main():
             # Print distribution summary
             print("\n   Distribution by bucket:")
             total = len(pending_labs)
-            for bucket in bucket_order:
-                bucket_total = len(pending_labs[pending_labs['bucket'] == bucket])
-                cultures = len(pending_labs[(pending_labs['bucket'] == bucket) & (pending_labs['is_culture'])])
-                other = bucket_total - cultures
+            for bucket, (other, cultures) in zip(BUCKET_LABELS, bucket_counts.tolist()):
+                bucket_total = cultures + other
                 pct = bucket_total / total * 100 if total > 0 else 0
                 cult_pct = cultures / bucket_total * 100 if bucket_total > 0 else 0
                 print(f"   {bucket:5s}: {bucket_total:4d} ({pct:5.1f}%) - Cultures: {cultures:4d} ({cult_pct:4.1f}%), Other: {other:4d}")
@@ -241,9 +339,9 @@ def main():
             print("   No pending labs found")
 
     # Export data
-    print("\n6. Exporting data files...")
-    obs_df.to_csv('analysis_lab_observations.csv', index=False)
-    enc_df.to_csv('analysis_encounters.csv', index=False)
+    print("\n5. Exporting data files...")
+    write_csv(obs_df, 'analysis_lab_observations.csv')
+    write_csv(enc_df, 'analysis_encounters.csv')
     print("   ✓ analysis_lab_observations.csv")
     print("   ✓ analysis_encounters.csv")
 